@@ -1,15 +1,39 @@
 import os
 import argparse
+import copy
+import html
+import json
+import pathlib
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from urllib.parse import urlparse, urlunparse
 
 import requests
+import requests.models
 import bs4
 from markdownify import MarkdownConverter
 from atlassian import Confluence
 
+try:
+    # decode API responses with orjson (Rust, several times faster than stdlib
+    # json) — atlassian-python-api goes through response.json(), so swapping
+    # the module requests delegates to speeds up every body.storage payload.
+    # orjson.JSONDecodeError subclasses json.JSONDecodeError, so requests'
+    # error handling is unaffected.
+    import orjson
+    requests.models.complexjson = orjson
+except ImportError:
+    pass
+
 
 ATTACHMENT_FOLDER_NAME = "attachments"
-DOWNLOAD_CHUNK_SIZE = 4 * 1024 * 1024   # 4MB, since we're single threaded this is safe to raise much higher
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024   # 1MB, throughput plateaus beyond this
+DEFAULT_WORKERS = 4
+EXPORT_INDEX_NAME = ".export_index.json"
+
+_SANITIZE_RE = re.compile(r"\.\.|/")
+_CDATA_RE = re.compile(r"<!\[CDATA\[(.*?)\]\]>", re.DOTALL)
 
 
 class ExportException(Exception):
@@ -17,9 +41,12 @@ class ExportException(Exception):
 
 
 class Exporter:
-    def __init__(self, url, username, token, out_dir, space, no_attach):
+    def __init__(self, url, username, token, out_dir, space, no_attach, workers=DEFAULT_WORKERS,
+                 keep_html=False):
         self.__out_dir = out_dir
         self.__parsed_url = urlparse(url)
+        # scheme://host, computed once; attachment URLs are built per download
+        self.__base_url = urlunparse((self.__parsed_url.scheme, self.__parsed_url.netloc, "", "", "", ""))
         self.__username = username
         self.__token = token
         self.__confluence = Confluence(url=urlunparse(self.__parsed_url),
@@ -28,88 +55,232 @@ class Exporter:
         self.__seen = set()
         self.__no_attach = no_attach
         self.__space = space
+        self.__workers = workers
+        self.__keep_html = keep_html
+        self.__lock = threading.Lock()
+        self.__executor = None
+        self.__futures = []
+
+        # one shared session for attachment downloads; urllib3's connection pool
+        # is thread-safe, so all workers reuse the same TCP/TLS connections
+        # instead of re-negotiating a handshake per file
+        self.__session = requests.Session()
+        self.__session.auth = (self.__username, self.__token)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=self.__workers,
+                                                pool_maxsize=self.__workers)
+        self.__session.mount("https://", adapter)
+        self.__session.mount("http://", adapter)
+
+        self.__created_dirs = set()
+
+        # index of the previous run, used to skip unchanged pages/attachments
+        self.__index_path = os.path.join(out_dir, EXPORT_INDEX_NAME)
+        self.__index = self.__load_index(self.__index_path)
+        self.__new_index = {}
+
+    def __ensure_dir(self, dirname):
+        # memoize to avoid a stat+mkdir per attachment for dirs we already made;
+        # racing threads just fall through to the idempotent makedirs
+        if dirname in self.__created_dirs:
+            return
+        os.makedirs(dirname, exist_ok=True)
+        self.__created_dirs.add(dirname)
+
+    @staticmethod
+    def __load_index(path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def __save_index(self):
+        os.makedirs(self.__out_dir, exist_ok=True)
+        tmp_path = self.__index_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.__new_index, f)
+        os.replace(tmp_path, self.__index_path)
+
+    def __submit(self, fn, *args):
+        with self.__lock:
+            self.__futures.append(self.__executor.submit(fn, *args))
+
+    def __drain(self):
+        # wait for the traversal to finish; tasks submit further tasks, so keep
+        # draining until the list stays empty. result() re-raises worker errors.
+        while True:
+            with self.__lock:
+                if not self.__futures:
+                    return
+                future = self.__futures.pop()
+            future.result()
 
     def __sanitize_filename(self, document_name_raw):
-        document_name = document_name_raw
-        for invalid in ["..", "/"]:
-            if invalid in document_name:
-                print("Dangerous page title: \"{}\", \"{}\" found, replacing it with \"_\"".format(
-                    document_name,
-                    invalid))
-                document_name = document_name.replace(invalid, "_")
-        return document_name
-
-    def __dump_page(self, src_id, parents):
-        if src_id in self.__seen:
-            # this could theoretically happen if Page IDs are not unique or there is a circle
-            raise ExportException("Duplicate Page ID Found!")
-
-        page = self.__confluence.get_page_by_id(src_id, expand="body.storage")
+        # fast path: most titles are clean, skip the regex entirely
+        if ".." not in document_name_raw and "/" not in document_name_raw:
+            return document_name_raw
+
+        print("Dangerous page title: \"{}\", replacing dangerous parts with \"_\"".format(
+            document_name_raw))
+        return _SANITIZE_RE.sub("_", document_name_raw)
+
+    def __fetch_space_pages(self, space_key):
+        # pull every page of the space (bodies, versions, ancestors included) in
+        # batches of 100 instead of one get_page_by_id round-trip per page
+        pages = {}
+        start = 0
+        limit = 100
+        while True:
+            batch = self.__confluence.get_all_pages_from_space(
+                space_key, start=start, limit=limit, expand="body.storage,version,ancestors")
+            # the server may clamp limit below what we asked for (Cloud does for
+            # body.storage expands), so a short batch does not mean we are done;
+            # only an empty one does
+            if not batch:
+                return pages
+            for page in batch:
+                pages[page["id"]] = page
+            start += len(batch)
+
+    def __dump_page(self, page, parents, pages, children):
         page_title = page["title"]
         page_id = page["id"]
-    
-        # see if there are any children
-        child_ids = self.__confluence.get_child_id_list(page_id)
-    
+        with self.__lock:
+            if page_id in self.__seen:
+                # this could theoretically happen if Page IDs are not unique or there is a circle
+                raise ExportException("Duplicate Page ID Found!")
+            self.__seen.add(page_id)
+
+        when_modified = page.get("version", {}).get("when")
+
+        # children are known from the batched listing, no extra API call needed
+        child_ids = children.get(page_id, [])
+
         content = page["body"]["storage"]["value"]
 
-        # save all files as .html for now, we will convert them later
-        extension = ".html"
         if len(child_ids) > 0:
-            document_name = "index" + extension
+            document_name = "index"
         else:
-            document_name = page_title + extension
+            document_name = page_title
 
         # make some rudimentary checks, to prevent trivial errors
         sanitized_filename = self.__sanitize_filename(document_name)
         sanitized_parents = list(map(self.__sanitize_filename, parents))
 
-        page_location = sanitized_parents + [sanitized_filename]
+        page_location = sanitized_parents + [sanitized_filename + ".md"]
         page_filename = os.path.join(self.__out_dir, *page_location)
+        html_filename = os.path.splitext(page_filename)[0] + ".html"
 
         page_output_dir = os.path.dirname(page_filename)
-        os.makedirs(page_output_dir, exist_ok=True)
-        print("Saving to {}".format(" / ".join(page_location)))
-        with open(page_filename, "w", encoding="utf-8") as f:
-            f.write(content)
+
+        # unchanged since the last run? then the files on disk are already
+        # current and the body write/convert can be skipped. Attachments are
+        # still listed below: adding or updating an attachment does not bump
+        # the page's version.when, so skipping them here would miss those
+        # forever; the If-None-Match/304 path keeps the re-check cheap.
+        previous = self.__index.get(page_id)
+        unchanged = previous is not None and when_modified is not None \
+            and previous.get("when") == when_modified and os.path.exists(page_filename) \
+            and (not self.__keep_html or os.path.exists(html_filename))
+
+        index_entry = {"when": when_modified, "attachments": {}}
+        old_etags = previous.get("attachments", {}) if previous is not None else {}
+        with self.__lock:
+            self.__new_index[page_id] = index_entry
+
+        if unchanged:
+            print("Unchanged, skipping {}".format(" / ".join(page_location)))
+        else:
+            self.__ensure_dir(page_output_dir)
+            print("Saving to {}".format(" / ".join(page_location)))
+            # convert while the body is still in memory instead of writing HTML and
+            # re-reading + re-parsing it in a second pass over the whole tree
+            if self.__keep_html:
+                pathlib.Path(html_filename).write_text(content, encoding="utf-8")
+            # write_text pushes the whole body out in one shot instead of splitting
+            # large pages across the default 8KiB-buffered writes
+            pathlib.Path(page_filename).write_text(_convert_body(content), encoding="utf-8")
 
         # fetch attachments unless disabled
         if not self.__no_attach:
-            ret = self.__confluence.get_attachments_from_content(page_id, start=0, limit=500, expand=None,
-                                                                 filename=None, media_type=None)
-            for i in ret["results"]:
-                att_title = i["title"]
-                download = i["_links"]["download"]
-
-                att_url = urlunparse(
-                    (self.__parsed_url[0], self.__parsed_url[1], "/wiki/" + download.lstrip("/"), None, None, None)
-                )
-                att_sanitized_name = self.__sanitize_filename(att_title)
-                att_filename = os.path.join(page_output_dir, ATTACHMENT_FOLDER_NAME, att_sanitized_name)
-
-                att_dirname = os.path.dirname(att_filename)
-                os.makedirs(att_dirname, exist_ok=True)
-
-                print("Saving attachment {} to {}".format(att_title, page_location))
-
-                r = requests.get(att_url, auth=(self.__username, self.__token), stream=True)
-                if 400 <= r.status_code:
-                    if r.status_code == 404:
-                        print("Attachment {} not found (404)!".format(att_url))
-                        continue
-
-                    # this is a real error, raise it
-                    r.raise_for_status()
-
-                with open(att_filename, "wb") as f:
-                    for buf in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
-                        f.write(buf)
-
-        self.__seen.add(page_id)
-    
-        # recurse to process child nodes
+            for i in self.__iter_attachments(page_id):
+                self.__submit(self.__download_attachment, i, page_output_dir, page_location,
+                              old_etags, index_entry["attachments"])
+
+        # fan child pages out to the worker pool instead of recursing
         for child_id in child_ids:
-            self.__dump_page(child_id, parents=sanitized_parents + [page_title])
+            self.__submit(self.__dump_page, pages[child_id], sanitized_parents + [page_title],
+                          pages, children)
+
+    def __iter_attachments(self, page_id):
+        # page through the listing instead of a single capped request, so pages
+        # with more attachments than one batch are not silently truncated
+        start = 0
+        limit = 100
+        while True:
+            ret = self.__confluence.get_attachments_from_content(page_id, start=start, limit=limit,
+                                                                 expand=None, filename=None, media_type=None)
+            results = ret["results"]
+            # as with the space listing, the server may clamp limit, so only an
+            # empty batch means the listing is exhausted
+            if not results:
+                return
+            yield from results
+            start += len(results)
+
+    def __download_attachment(self, attachment, page_output_dir, page_location, old_etags, new_etags):
+        att_title = attachment["title"]
+        download = attachment["_links"]["download"]
+
+        att_url = f"{self.__base_url}/wiki/{download.lstrip('/')}"
+        att_sanitized_name = self.__sanitize_filename(att_title)
+        att_filename = os.path.join(page_output_dir, ATTACHMENT_FOLDER_NAME, att_sanitized_name)
+
+        att_dirname = os.path.dirname(att_filename)
+        self.__ensure_dir(att_dirname)
+
+        # ask the server to answer 304 if the attachment did not change since last run
+        headers = {}
+        cached = old_etags.get(download)
+        if cached is not None and os.path.exists(att_filename):
+            if cached.get("etag"):
+                headers["If-None-Match"] = cached["etag"]
+            if cached.get("last_modified"):
+                headers["If-Modified-Since"] = cached["last_modified"]
+
+        with self.__session.get(att_url, stream=True, headers=headers) as r:
+            if r.status_code == 304:
+                print("Attachment {} unchanged, skipping".format(att_title))
+                new_etags[download] = cached
+                return
+
+            if 400 <= r.status_code:
+                if r.status_code == 404:
+                    print("Attachment {} not found (404)!".format(att_url))
+                    return
+
+                # this is a real error, raise it
+                r.raise_for_status()
+
+            print("Saving attachment {} to {}".format(att_title, page_location))
+
+            # read into one reusable buffer: unlike copyfileobj, which allocates
+            # a fresh bytes object per chunk, this keeps a single allocation for
+            # the whole download (os.sendfile would need the raw socket, which
+            # TLS and content decoding rule out)
+            raw = r.raw
+            raw.decode_content = True
+            buf = bytearray(DOWNLOAD_CHUNK_SIZE)
+            view = memoryview(buf)
+            with open(att_filename, "wb") as f:
+                while True:
+                    n = raw.readinto(view)
+                    if not n:
+                        break
+                    f.write(view[:n])
+
+            new_etags[download] = {"etag": r.headers.get("ETag"),
+                                   "last_modified": r.headers.get("Last-Modified")}
 
     def __dump_space(self, space):
         space_key = space["key"]
@@ -119,71 +290,118 @@ class Exporter:
             print("In order for this tool to work there has to be a root page!")
             raise ExportException("No homepage found")
         else:
-            # homepage found, recurse from there
             homepage_id = space["homepage"]["id"]
-            self.__dump_page(homepage_id, parents=[space_key])
+            pages = self.__fetch_space_pages(space_key)
+            if homepage_id not in pages:
+                raise ExportException("Homepage not found in space page listing")
+
+            # build the parent -> children adjacency from the ancestors field,
+            # then traverse purely from in-memory data
+            children = {}
+            for page_id, page in pages.items():
+                ancestors = page.get("ancestors") or []
+                if ancestors:
+                    children.setdefault(ancestors[-1]["id"], []).append(page_id)
+
+            self.__submit(self.__dump_page, pages[homepage_id], [space_key], pages, children)
+
 
-    
     def dump(self):
         ret = self.__confluence.get_all_spaces(start=0, limit=500, expand='description.plain,homepage')
         if ret['size'] == 0:
             print("No spaces found in confluence. Please check credentials")
-        for space in ret["results"]:
-            if self.__space is None or space["key"] == self.__space:
-                self.__dump_space(space)
+        with ThreadPoolExecutor(max_workers=self.__workers) as executor:
+            self.__executor = executor
+            for space in ret["results"]:
+                if self.__space is None or space["key"] == self.__space:
+                    self.__dump_space(space)
+            self.__drain()
+        self.__save_index()
+
+
+def _convert_atlassian_html(soup):
+    # prototype tag cloned per image, cheaper than a new_tag call each time
+    br_proto = soup.new_tag("br")
+    for image in soup.find_all("ac:image"):
+        url = None
+        for child in image.children:
+            url = child.get("ri:filename", None)
+            break
+
+        if url is None:
+            # no url found for ac:image
+            continue
+
+        # construct new, actually valid HTML tag ("/" is the right separator in HTML src)
+        srcurl = f"{ATTACHMENT_FOLDER_NAME}/{url}"
+        imgtag = soup.new_tag("img", attrs={"src": srcurl, "alt": srcurl})
+
+        # insert a linebreak after the original "ac:image" tag, then replace with an actual img tag
+        image.insert_after(copy.copy(br_proto))
+        image.replace_with(imgtag)
+    return soup
+
+
+# one converter per process; MarkdownConverter holds no per-document state, so
+# reusing it skips re-building the options dict for every file
+_MD_CONVERTER = MarkdownConverter()
+
+
+def _convert_body(data):
+    # libxml2's HTML parser reads CDATA sections (Confluence code-macro
+    # bodies) as bogus comments and cuts them at the first ">", losing the
+    # code; escape them into plain text first so the parser unescapes them
+    # back to the exact original content, as html.parser used to
+    data = _CDATA_RE.sub(lambda m: html.escape(m.group(1), quote=False), data)
+
+    # lxml's C parser is several times faster than the stdlib html.parser on
+    # the large storage-format dumps Confluence produces ('lxml-xml' is not an
+    # option: it namespace-strips ac:/ri: tags so find_all("ac:image") misses)
+    soup_raw = bs4.BeautifulSoup(data, 'lxml')
+    soup = _convert_atlassian_html(soup_raw)
+    return _MD_CONVERTER.convert_soup(soup)
+
+
+def _convert_page(path):
+    # module-level so it can be pickled into process-pool workers
+    print("Converting {}".format(path))
+    with open(path, "r", encoding="utf-8") as f:
+        data = f.read()
+
+    md = _convert_body(data)
+    newname = os.path.splitext(path)[0]
+    with open(newname + ".md", "w", encoding="utf-8") as f:
+        f.write(md)
 
 
 class Converter:
     def __init__(self, out_dir):
         self.__out_dir = out_dir
 
-    def recurse_findfiles(self, path):
-        for entry in os.scandir(path):
-            if entry.is_dir(follow_symlinks=False):
-                yield from self.recurse_findfiles(entry.path)
-            elif entry.is_file(follow_symlinks=False):
-                yield entry
-            else:
-                raise NotImplemented()
-
-    def __convert_atlassian_html(self, soup):
-        for image in soup.find_all("ac:image"):
-            url = None
-            for child in image.children:
-                url = child.get("ri:filename", None)
-                break
-
-            if url is None:
-                # no url found for ac:image
-                continue
-
-            # construct new, actually valid HTML tag
-            srcurl = os.path.join(ATTACHMENT_FOLDER_NAME, url)
-            imgtag = soup.new_tag("img", attrs={"src": srcurl, "alt": srcurl})
-
-            # insert a linebreak after the original "ac:image" tag, then replace with an actual img tag
-            image.insert_after(soup.new_tag("br"))
-            image.replace_with(imgtag)
-        return soup
+    def recurse_findfiles(self, path, suffix=".html"):
+        # explicit work stack instead of recursion, so directory depth is not
+        # capped by the interpreter recursion limit; filtering on entry.name
+        # here avoids materializing paths for attachments we will never touch
+        stack = [path]
+        while stack:
+            for entry in os.scandir(stack.pop()):
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    if entry.name.endswith(suffix):
+                        yield entry.path
+                # anything else (symlinks, fifos, ...) was not produced by the
+                # exporter, just leave it alone
 
     def convert(self):
-        for entry in self.recurse_findfiles(self.__out_dir):
-            path = entry.path
+        paths = list(self.recurse_findfiles(self.__out_dir))
+        if not paths:
+            return
 
-            if not path.endswith(".html"):
-                continue
-
-            print("Converting {}".format(path))
-            with open(path, "r", encoding="utf-8") as f:
-                data = f.read()
-
-            soup_raw = bs4.BeautifulSoup(data, 'html.parser')
-            soup = self.__convert_atlassian_html(soup_raw)
-
-            md = MarkdownConverter().convert_soup(soup)
-            newname = os.path.splitext(path)[0]
-            with open(newname + ".md", "w", encoding="utf-8") as f:
-                f.write(md)
+        # parsing + markdownify are CPU-bound pure Python, so fan the files out
+        # over processes; chunksize amortizes the per-task IPC cost
+        with ProcessPoolExecutor() as executor:
+            list(executor.map(_convert_page, paths, chunksize=16))
 
 
 if __name__ == "__main__":
@@ -197,12 +415,19 @@ if __name__ == "__main__":
                         default=False, help="Skip fetching attachments")
     parser.add_argument("--no-fetch", action="store_true", dest="no_fetch", required=False,
                         default=False, help="This option only runs the markdown conversion")
+    parser.add_argument("--workers", type=int, required=False, default=DEFAULT_WORKERS,
+                        help="Number of worker threads used to fetch pages and attachments")
+    parser.add_argument("--keep-html", action="store_true", dest="keep_html", required=False,
+                        default=False, help="Also keep the raw .html next to the converted .md")
     args = parser.parse_args()
-    
-    if not args.no_fetch:
+
+    if args.no_fetch:
+        # conversion-only mode for .html files produced by an earlier --keep-html run
+        converter = Converter(out_dir=args.out_dir)
+        converter.convert()
+    else:
+        # fetching converts in the same pass, no separate conversion run needed
         dumper = Exporter(url=args.url, username=args.username, token=args.token, out_dir=args.out_dir,
-                          space=args.space, no_attach=args.no_attach)
+                          space=args.space, no_attach=args.no_attach, workers=args.workers,
+                          keep_html=args.keep_html)
         dumper.dump()
-    
-    converter = Converter(out_dir=args.out_dir)
-    converter.convert()